@@ -0,0 +1,43 @@
+""" Benchmark import time and construct/destroy time of Chest
+
+Run from the repository root::
+
+    python benchmarks/construct.py
+"""
+from __future__ import print_function
+
+import subprocess
+import sys
+import time
+from timeit import repeat
+
+
+def import_time(n=20):
+    """ Best wall time of ``import chest`` in a fresh interpreter, less the
+    time to start an interpreter that imports nothing """
+    def best(code):
+        times = []
+        for i in range(n):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', code])
+            times.append(time.time() - start)
+        return min(times)
+    return best('import chest') - best('pass')
+
+
+def construct_time(stmt, n=1000):
+    """ Best per-call time of stmt, which should include ``del`` so that
+    ``Chest.__del__`` is timed too """
+    setup = 'from chest import Chest'
+    return min(repeat(stmt, setup, number=n, repeat=5)) / n
+
+
+if __name__ == '__main__':
+    print('import chest:              %8.2f ms' % (1e3 * import_time()))
+    print('Chest(); del:              %8.2f us' %
+          (1e6 * construct_time('c = Chest(); del c')))
+    print('Chest(); setitem; del:     %8.2f us' %
+          (1e6 * construct_time("c = Chest(); c['x'] = 1; del c")))
+    print('Chest(); spill; del/drop:  %8.2f us' %
+          (1e6 * construct_time("c = Chest(available_memory=0); "
+                                "c['x'] = 1; del c")))
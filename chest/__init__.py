@@ -1,3 +1,5 @@
 from .core import Chest
+from .sharded import ShardedChest
+from .memory import MemoryBudget
 
 __version__ = '0.2.0'
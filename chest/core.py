@@ -1,14 +1,11 @@
 from collections import MutableMapping
-from functools import partial
-from threading import Lock
+from threading import Lock, Event
+import errno
 import sys
-import tempfile
-import shutil
 import os
-import re
-import pickle
-from heapdict import heapdict
-import hashlib
+
+# Other imports (tempfile, shutil, re, hashlib, pickle, heapdict, rawio)
+# happen where they are used so that ``import chest`` stays cheap
 
 DEFAULT_AVAILABLE_MEMORY = 1e9
 
@@ -19,6 +16,7 @@ def key_to_filename(key):
     >>> type(key_to_filename(('foo', 'bar'))).__name__
     'str'
     """
+    import re
     if isinstance(key, str) and re.match('^[_a-zA-Z]\w*$', key):
         return key
     if isinstance(key, tuple):
@@ -26,6 +24,7 @@ def key_to_filename(key):
                  [key_to_filename(key[-1])])
         return os.path.join(*names)
     else:
+        import hashlib
         return str(hashlib.md5(str(key).encode()).hexdigest())
 
 
@@ -33,6 +32,19 @@ def _do_nothing(*args, **kwargs):
     pass
 
 
+def _dump(obj, f):
+    import pickle
+    pickle.dump(obj, f, protocol=1)
+
+
+def _load(f):
+    import pickle
+    return pickle.load(f)
+
+
+_missing = object()
+
+
 class Chest(MutableMapping):
     """ A Dictionary that spills to disk
 
@@ -47,8 +59,11 @@ class Chest(MutableMapping):
         An initial dictionary to seed the chest
     path : str (optional)
         A directory path to store contents of the chest.  Defaults to a tmp dir
-    available_memory : int (optional)
-        Number of bytes that a chest should use for in-memory storage
+        The directory is only created once it is needed, e.g. on first spill
+    available_memory : int, MemoryBudget or 'auto' (optional)
+        Number of bytes that a chest should use for in-memory storage.  A
+        ``MemoryBudget`` adjusts this to memory pressure and may be shared
+        between chests.  ``'auto'`` uses the process-wide default budget
     dump : function (optional)
         A function like pickle.dump or json.dump that dumps contents to file
     load : function(optional)
@@ -57,6 +72,17 @@ class Chest(MutableMapping):
         A function to determine filenames from key values
     mode : str (t or b)
         Binary or text mode for file storage
+    compute : function (optional)
+        A function to produce the value of a key that is missing from the
+        chest (or whose file has gone from disk).  Results are stored in the
+        chest as normal.  Concurrent requests for the same missing key share
+        a single call.
+    raw_buffers : bool (optional)
+        Write bytes, memoryviews and numpy arrays directly to file rather
+        than through ``dump``.  Only used in binary mode with the default
+        ``dump`` and ``load``.  Defaults to True
+    direct_io : bool (optional)
+        Use ``O_DIRECT`` for large raw buffers to bypass the page cache
 
     Examples
     --------
@@ -74,11 +100,11 @@ class Chest(MutableMapping):
     >>> c.drop()
     """
     def __init__(self, data=None, path=None, available_memory=None,
-                 dump=partial(pickle.dump, protocol=1),
-                 load=pickle.load,
+                 dump=_dump,
+                 load=_load,
                  key_to_filename=key_to_filename,
                  on_miss=_do_nothing, on_overflow=_do_nothing,
-                 mode='b'):
+                 mode='b', compute=None, raw_buffers=True, direct_io=False):
         # In memory storage
         self.inmem = data or dict()
         # A set of keys held both in memory or on disk
@@ -87,27 +113,43 @@ class Chest(MutableMapping):
                           (set(data) if data is not None else {}))
         # Was a path given or no?  If not we'll clean up the directory later
         self._explicitly_given_path = path is not None
-        # Diretory where the on-disk data will be held
-        self.path = path or tempfile.mkdtemp('.chest')
-        if not os.path.exists(self.path):
-            os.mkdir(self.path)
-        # Amount of memory we're allowed to use
+        # Diretory where the on-disk data will be held, created lazily
+        self._path = path
+        self._path_created = path is not None and os.path.exists(path)
+        # Amount of memory we're allowed to use, maybe set by a MemoryBudget
+        if isinstance(available_memory, str) and available_memory == 'auto':
+            from .memory import default_budget
+            available_memory = default_budget()
+        self._budget = None
+        if hasattr(available_memory, 'register'):
+            self._budget, available_memory = available_memory, None
         self.available_memory = (available_memory if available_memory
                                  is not None else DEFAULT_AVAILABLE_MEMORY)
         # Functions to control disk I/O
         self.load = load
         self.dump = dump
         self.mode = mode
+        self._raw_buffers = (raw_buffers and mode == 'b' and
+                             dump is _dump and load is _load)
+        self._direct_io = direct_io
         self._key_to_filename = key_to_filename
 
-        keyfile = os.path.join(self.path, '.keys')
-        if os.path.exists(keyfile):
+        keyfile = self._path_created and os.path.join(self._path, '.keys')
+        if keyfile and os.path.exists(keyfile):
             with open(keyfile, mode='r'+self.mode) as f:
                 self._keys = dict(self.load(f))
 
         self.lock = Lock()
 
+        # Snapshots refuse writes
+        self._readonly = False
+
+        # Compute-on-miss state, keys being computed map to (Event, result)
+        self._compute = compute
+        self._computing = dict()
+
         # LRU state
+        from heapdict import heapdict
         self.counter = 0
         self.heap = heapdict()
 
@@ -115,8 +157,25 @@ class Chest(MutableMapping):
         self._on_miss = on_miss
         self._on_overflow = on_overflow
 
+        if self._budget is not None:
+            self._budget.register(self)
+
     def __str__(self):
-        return '<chest at %s>' % self.path
+        # Don't create the directory just to print it
+        return '<chest at %s>' % (self._path if self._path is not None
+                                  else '<not yet created>')
+
+    @property
+    def path(self):
+        """ Directory holding on-disk data, created on first access """
+        if not self._path_created:
+            if self._path is None:
+                import tempfile
+                self._path = tempfile.mkdtemp('.chest')
+            elif not os.path.exists(self._path):
+                os.mkdir(self._path)
+            self._path_created = True
+        return self._path
 
     def key_to_filename(self, key):
         """ Filename where key will be held """
@@ -133,11 +192,15 @@ class Chest(MutableMapping):
             dir = os.path.dirname(fn)
             if not os.path.exists(dir):
                 os.makedirs(dir)
+            from .rawio import dump_buffer
             try:
-                with open(fn, mode='w'+self.mode) as f:
-                    self.dump(self.inmem[key], f)
-            except TypeError:
-                os.remove(fn)
+                if not (self._raw_buffers and
+                        dump_buffer(self.inmem[key], fn, self._direct_io)):
+                    with open(fn, mode='w'+self.mode) as f:
+                        self.dump(self.inmem[key], f)
+            except Exception:  # don't leave a partial file behind
+                if os.path.exists(fn):
+                    os.remove(fn)
                 raise
         del self.inmem[key]
 
@@ -148,9 +211,13 @@ class Chest(MutableMapping):
 
         self._on_miss(key)
 
+        from .rawio import is_buffer_file, load_buffer
         fn = self.key_to_filename(key)
         with open(fn, mode='r'+self.mode) as f:
-            value = self.load(f)
+            if self.mode == 'b' and is_buffer_file(f):
+                value = load_buffer(f, self._direct_io)
+            else:
+                value = self.load(f)
 
         self.inmem[key] = value
 
@@ -158,36 +225,102 @@ class Chest(MutableMapping):
         with self.lock:
             if key in self.inmem:
                 value = self.inmem[key]
-            else:
-                if key not in self._keys:
-                    raise KeyError("Key not found: %s" % key)
-
+            elif key in self._keys and not self._needs_compute(key):
                 self.get_from_disk(key)
                 value = self.inmem[key]
                 self._update_lru(key)
+            elif self._compute is None:
+                raise KeyError("Key not found: %s" % key)
+            else:
+                value = _missing
+
+        if value is _missing:
+            return self.compute(key)
 
         with self.lock:
             self.shrink()
 
         return value
 
+    def _needs_compute(self, key):
+        """ Has the file for this key gone missing and can we rebuild it? """
+        return (self._compute is not None and
+                not os.path.exists(self.key_to_filename(key)))
+
+    def compute(self, key):
+        """ Compute value of missing key and store it in the chest
+
+        Only one thread computes a given key at a time.  Other threads asking
+        for the same key wait for that result, or that exception, rather than
+        computing it again.
+        """
+        with self.lock:
+            # Another thread may have stored key since our caller saw it miss
+            if key in self.inmem:
+                return self.inmem[key]
+            if key in self._keys and not self._needs_compute(key):
+                self.get_from_disk(key)
+                self._update_lru(key)
+                flight = None
+                value = self.inmem[key]
+            else:
+                flight = self._computing.get(key)
+                if flight is None:
+                    flight = self._computing[key] = (Event(), dict())
+                    owner = True
+                else:
+                    owner = False
+
+        if flight is None:
+            with self.lock:
+                self.shrink()
+            return value
+
+        event, result = flight
+
+        if not owner:
+            event.wait()
+            if 'error' in result:
+                raise result['error']
+            return result['value']
+
+        try:
+            self._on_miss(key)
+            value = self._compute(key)
+            self[key] = value
+            result['value'] = value
+        except BaseException as e:
+            result['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self._computing[key]
+            event.set()
+
+        return value
+
     def _update_lru(self, key):
         self.counter += 1
         self.heap[key] = self.counter
 
     def __delitem__(self, key):
+        if self._readonly:
+            raise TypeError("Chest snapshot is read-only")
         if key in self.inmem:
             del self.inmem[key]
         if key in self.heap:
             del self.heap[key]
 
-        fn = self.key_to_filename(key)
-        if os.path.exists(fn):
-            os.remove(fn)
+        if self._path_created:  # otherwise nothing is on disk
+            fn = self.key_to_filename(key)
+            if os.path.exists(fn):
+                os.remove(fn)
 
         del self._keys[key]
 
     def __setitem__(self, key, value):
+        if self._readonly:
+            raise TypeError("Chest snapshot is read-only")
         with self.lock:
             if key in self._keys:
                 del self[key]
@@ -201,13 +334,13 @@ class Chest(MutableMapping):
 
     def __del__(self):
         if self._explicitly_given_path:
-            if os.path.exists(self.path):
+            if not self._path_created or os.path.exists(self._path):
                 self.flush()
             else:
                 with self.lock:
                     for key in list(self.inmem):
                         del self.inmem[key]
-        elif os.path.exists(self.path):
+        elif self._path_created and os.path.exists(self._path):
             with self.lock:
                 self.drop()  # pragma: no cover
 
@@ -232,12 +365,17 @@ class Chest(MutableMapping):
         Just implemented with "dump the biggest" for now.  This could be
         improved to LRU or some such.  Ideally this becomes an input.
         """
+        if self._budget is not None:
+            self._budget.maybe_refresh()
+
         mem = self.memory_usage
         if mem < self.available_memory:
             return
 
-        while mem > self.available_memory:
+        while mem > self.available_memory and self.heap:
             key, _ = self.heap.popitem()
+            if key not in self.inmem:  # already flushed
+                continue
             data = self.inmem[key]
             try:
                 self.move_to_disk(key)
@@ -247,7 +385,12 @@ class Chest(MutableMapping):
 
     def drop(self):
         """ Permanently remove directory from disk """
-        shutil.rmtree(self.path)
+        import shutil
+        if self._path is None:
+            return
+        self._path_created = True  # don't bring it back on access
+        if os.path.exists(self._path):
+            shutil.rmtree(self._path)
 
     def write_keys(self):
         fn = os.path.join(self.path, '.keys')
@@ -266,8 +409,7 @@ class Chest(MutableMapping):
 
     def __exit__(self, eType, eValue, eTrace):
         with self.lock:
-            L = os.listdir(self.path)
-            if not self._explicitly_given_path and os.path.exists(self.path):
+            if not self._explicitly_given_path and self._path_created:
                 self.drop()  # pragma: no cover
 
         if eValue is not None:
@@ -277,21 +419,98 @@ class Chest(MutableMapping):
 
     def update(self, other, overwrite=True):
         """ Copy (hard-link) the contents of chest other to this chest """
+        if self._readonly:
+            raise TypeError("Chest snapshot is read-only")
         #  if already flushed, then this does nothing
         self.flush()
         other.flush()
         for key in other._keys:
-            if key in self._keys and overwrite:
-                del self[key]
-            elif key in self._keys and not overwrite:
-                continue
-            old_fn = other.key_to_filename(key)
-            self._keys[key] = self._key_to_filename(key)
-            new_fn = self.key_to_filename(key)
-            dir = os.path.dirname(new_fn)
-            if not os.path.exists(dir):
-                os.makedirs(dir)
-            os.link(old_fn, new_fn)
+            self._link_from(other, key, overwrite=overwrite)
+
+    def _link_from(self, other, key, overwrite=True):
+        """ Hard-link the file for key from flushed chest other into this one
+        """
+        if self._readonly:
+            raise TypeError("Chest snapshot is read-only")
+        if key in self._keys and overwrite:
+            del self[key]
+        elif key in self._keys and not overwrite:
+            return
+        old_fn = other.key_to_filename(key)
+        self._keys[key] = self._key_to_filename(key)
+        _link(old_fn, self.key_to_filename(key))
+
+    def snapshot(self, path=None):
+        """ A read-only, point-in-time view of this chest
+
+        Files already on disk are hard-linked rather than copied.  Chest
+        never writes into an existing file, overwritten keys always get a new
+        one, so later changes to this chest do not show through to the
+        snapshot.  Values held only in memory are written to the snapshot's
+        own files so that later in-place changes to them don't show through
+        either.  Values that can't be dumped are shared by reference.
+
+        >>> c = Chest()
+        >>> c['x'] = 1
+        >>> s = c.snapshot()
+        >>> c['x'] = 2
+        >>> s['x']
+        1
+        >>> c.drop()
+        """
+        explicit = path is not None
+        if path is None:
+            # Same filesystem as our files so that hard links work.  Don't
+            # touch self.path, which would create a directory we may not need
+            import tempfile
+            parent = (os.path.dirname(os.path.abspath(self._path))
+                      if self._path is not None else None)
+            path = tempfile.mkdtemp('.chest', dir=parent)
+
+        snap = Chest(path=path, available_memory=self.available_memory,
+                     dump=self.dump, load=self.load,
+                     key_to_filename=self._key_to_filename, mode=self.mode,
+                     raw_buffers=self._raw_buffers, direct_io=self._direct_io)
+        snap._explicitly_given_path = explicit
+
+        try:
+            with self.lock:
+                snap._keys = dict(self._keys)
+                for key in self._keys:
+                    # Nothing is on disk if our directory was never created
+                    fn = self._path_created and self.key_to_filename(key)
+                    if fn and os.path.exists(fn):
+                        _link(fn, snap.key_to_filename(key))
+                    elif key in self.inmem:
+                        snap.inmem[key] = self.inmem[key]
+                        try:
+                            snap.move_to_disk(key)
+                        except Exception:  # can't be dumped, share it
+                            snap._update_lru(key)
+                    else:  # file has gone, e.g. awaiting recompute
+                        del snap._keys[key]
+        except BaseException:
+            if not explicit:
+                snap.drop()
+            raise
+
+        snap._readonly = True
+        return snap
+
+
+def _link(old_fn, new_fn):
+    """ Hard-link old_fn to new_fn, copying if a link is not possible """
+    dir = os.path.dirname(new_fn)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    try:
+        os.link(old_fn, new_fn)
+    except OSError as e:
+        # Across filesystems, or where hard links aren't allowed
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        from .rawio import copy_file
+        copy_file(old_fn, new_fn)
 
 
 def nbytes(o):
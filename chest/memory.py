@@ -0,0 +1,295 @@
+""" Memory-pressure-driven budgets for chests
+
+A ``MemoryBudget`` watches the memory of this process and of the machine or
+container it runs in and sets ``available_memory`` on every chest that uses
+it.  Chests grow into free memory and give it back, by spilling, when other
+processes need it.
+
+>>> from chest import Chest
+>>> budget = MemoryBudget()
+>>> a = Chest(available_memory=budget)
+>>> b = Chest(available_memory=budget)
+>>> a['x'] = 1
+>>> a.available_memory > 0
+True
+>>> a.drop(); b.drop()
+"""
+from threading import Lock, Thread, Event
+import os
+import time
+import weakref
+
+from .core import DEFAULT_AVAILABLE_MEMORY, nbytes
+
+PROC_CGROUP = '/proc/self/cgroup'
+CGROUP_V2 = '/sys/fs/cgroup'
+CGROUP_V1 = '/sys/fs/cgroup/memory'
+
+
+def _read_int(fn):
+    """ Integer in file fn, None if missing, unreadable or ``max`` """
+    try:
+        with open(fn) as f:
+            text = f.read().strip()
+    except (IOError, OSError):
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+def _meminfo():
+    """ Dict of /proc/meminfo entries in bytes """
+    result = dict()
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                parts = rest.split()
+                if parts:
+                    result[name] = int(parts[0]) * 1024
+    except (IOError, OSError):  # pragma: no cover
+        pass
+    return result
+
+
+def process_rss():
+    """ Resident set size of this process in bytes, None if unknown """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):  # pragma: no cover
+        return None
+
+
+def own_cgroups():
+    """ This process's cgroup paths for v2 and for the v1 memory controller
+
+    Taken from /proc/self/cgroup, relative to the hierarchy root.  Either is
+    ``''`` (the root) if not found.
+    """
+    v2 = v1 = ''
+    try:
+        with open(PROC_CGROUP) as f:
+            for line in f:
+                parts = line.rstrip('\n').split(':', 2)
+                if len(parts) != 3:
+                    continue
+                hierarchy, controllers, path = parts
+                if hierarchy == '0' and not controllers:
+                    v2 = path.strip('/')
+                elif 'memory' in controllers.split(','):
+                    v1 = path.strip('/')
+    except (IOError, OSError):
+        pass
+    return v2, v1
+
+
+def _read_stat(fn, name):
+    """ Value of name in a cgroup ``memory.stat`` file, None if missing """
+    try:
+        with open(fn) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[0] == name:
+                    return int(parts[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _cgroup_limit(root, path, limit_name, usage_name, inactive_name):
+    """ Tightest memory limit from cgroup path up to root, with its usage
+
+    Usage is the working set: the usage counter less inactive page cache,
+    which the kernel can reclaim.  Otherwise every spill would add to usage
+    and make chests spill more.  Returns ``(None, None)`` if no level has a
+    limit.
+    """
+    parts = [p for p in path.split('/') if p]
+    limit = usage = None
+    for i in range(len(parts), -1, -1):
+        dir = os.path.join(root, *parts[:i])
+        lim = _read_int(os.path.join(dir, limit_name))
+        if lim is not None and (limit is None or lim < limit):
+            limit = lim
+            usage = _read_int(os.path.join(dir, usage_name))
+            inactive = _read_stat(os.path.join(dir, 'memory.stat'),
+                                  inactive_name)
+            if usage is not None and inactive is not None:
+                usage = max(usage - inactive, 0)
+    return limit, usage
+
+
+def memory_stats():
+    """ Memory limit and free memory for this process in bytes
+
+    Uses the tighter of the system (/proc/meminfo) and cgroup (v2 or v1)
+    numbers.  The cgroup is this process's own, from /proc/self/cgroup,
+    along with its ancestors.  Cgroup usage leaves out inactive page cache,
+    as ``MemAvailable`` does.  Either value may be None if it can't be
+    found.
+    """
+    meminfo = _meminfo()
+    limits = [meminfo.get('MemTotal')]
+    free = [meminfo.get('MemAvailable', meminfo.get('MemFree'))]
+
+    v2, v1 = own_cgroups()
+    for root, path, limit_name, usage_name, inactive_name in [
+            (CGROUP_V2, v2, 'memory.max', 'memory.current', 'inactive_file'),
+            (CGROUP_V1, v1, 'memory.limit_in_bytes',
+             'memory.usage_in_bytes', 'total_inactive_file')]:
+        limit, usage = _cgroup_limit(root, path, limit_name, usage_name,
+                                     inactive_name)
+        if limit is not None:
+            limits.append(limit)
+            if usage is not None:
+                free.append(max(limit - usage, 0))
+            break
+
+    limits = [x for x in limits if x is not None]
+    free = [x for x in free if x is not None]
+    return {'limit': min(limits) if limits else None,
+            'free': min(free) if free else None,
+            'rss': process_rss()}
+
+
+class MemoryBudget(object):
+    """ Share one adaptive memory budget between several chests
+
+    The total budget for all chests is the memory they already use plus
+    free memory, less a reserve of ``1 - target`` of the memory limit.  It
+    is also capped so that the whole process stays below ``target`` of the
+    limit.  When free memory drops the budget falls below current use and
+    chests spill; when memory frees up chests may use the headroom.
+
+    Paramters
+    ---------
+
+    target : float (optional)
+        Fraction of the memory limit the process may use.  Defaults to 0.8
+    minimum : int (optional)
+        Smallest budget given to any one chest
+    interval : float (optional)
+        Seconds between reading memory statistics
+
+    Pass a ``MemoryBudget`` as ``available_memory=`` to ``Chest`` or use
+    ``available_memory='auto'`` to share the process-wide ``default_budget``.
+    ``start()`` runs a background thread that also spills chests as soon as
+    pressure rises, rather than on their next write.
+    """
+    def __init__(self, target=0.8, minimum=0, interval=1.0):
+        self.target = target
+        self.minimum = minimum
+        self.interval = interval
+        self.chests = weakref.WeakValueDictionary()  # id -> chest
+        self.lock = Lock()
+        self._last = 0
+        self._share = None  # budget for a new chest, from the last refresh
+        self._stop = Event()
+        self._thread = None
+
+    def stats(self):
+        """ Memory statistics, see ``memory_stats`` """
+        return memory_stats()
+
+    def register(self, chest):
+        """ Have this budget set ``chest.available_memory``
+
+        The new chest starts with a share of the headroom found by the last
+        refresh.  Only the very first registration refreshes, later ones
+        wait for ``maybe_refresh`` so that creating many chests stays cheap.
+        """
+        with self.lock:
+            self.chests[id(chest)] = chest
+            share = self._share
+            if share is not None:
+                chest.available_memory = share
+        if share is None:
+            self.refresh()
+
+    def total(self, used):
+        """ Bytes that all chests together may hold in memory """
+        stats = self.stats()
+        limit, free, rss = stats['limit'], stats['free'], stats['rss']
+        if limit is None or free is None:
+            return DEFAULT_AVAILABLE_MEMORY
+        total = used + free - (1 - self.target) * limit
+        if rss is not None:
+            total = min(total, self.target * limit - (rss - used))
+        return max(total, 0)
+
+    def refresh(self, spill=False):
+        """ Recompute and assign the budget of every chest
+
+        With ``spill=True`` also shrink chests that are now over budget.
+        This takes each chest's lock in turn, so don't call it while
+        holding one.
+        """
+        with self.lock:
+            self._last = time.time()
+            chests = list(self.chests.values())
+            if not chests:
+                return
+            usage = [sum(map(nbytes, list(c.inmem.values())))
+                     for c in chests]
+            used = sum(usage)
+            total = self.total(used)
+            extra = total - used
+            self._share = max(extra / len(chests), self.minimum)
+
+            for chest, use in zip(chests, usage):
+                if extra >= 0:
+                    budget = use + extra / len(chests)
+                else:
+                    budget = use * total / used
+                chest.available_memory = max(budget, self.minimum)
+
+        if spill:
+            for chest in chests:
+                with chest.lock:
+                    chest.shrink()
+
+    def maybe_refresh(self):
+        """ Refresh if ``interval`` has passed and nobody else is """
+        if time.time() - self._last < self.interval:
+            return
+        if self.lock.acquire(False):
+            self.lock.release()
+            self.refresh()
+
+    def start(self):
+        """ Refresh and spill every ``interval`` seconds in the background """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh(spill=True)
+
+
+_default_budget = []
+_default_budget_lock = Lock()
+
+
+def default_budget():
+    """ The process-wide ``MemoryBudget`` used by ``available_memory='auto'``
+    """
+    with _default_budget_lock:
+        if not _default_budget:
+            _default_budget.append(MemoryBudget())
+        return _default_budget[0]
@@ -0,0 +1,278 @@
+""" Raw file I/O for buffer-like values
+
+Values that expose a contiguous buffer (``bytes``, ``bytearray``,
+``memoryview`` and plain numpy arrays) are written straight to file
+descriptors rather than through ``pickle``.  Such a file is a short header
+followed by the raw bytes::
+
+    MAGIC | uint32 header length | json header | padding | data
+
+When writing with ``direct=True`` the data starts on an ``ALIGN`` boundary
+and is written with ``O_DIRECT`` (where the OS and filesystem allow it) so
+that large spills bypass the page cache.
+
+The fast path needs ``memoryview.cast`` (Python 3.3+).  Elsewhere
+``as_buffer`` declines every value and ``pickle`` is used as before.
+"""
+import errno
+import json
+import mmap
+import os
+import shutil
+import struct
+
+MAGIC = b'CHESTBUF'
+ALIGN = 4096
+DIRECT_THRESHOLD = 2 ** 20
+CHUNK = 2 ** 22
+
+_prefix = struct.Struct('<I')
+_memoryview_formats = 'bBhHiIlLqQnNfd?c'
+
+
+def _round_up(n, align):
+    return -(-n // align) * align
+
+
+def as_buffer(value):
+    """ Header and flat byte memoryview of value, or None if not a buffer
+
+    >>> header, data = as_buffer(b'abc')
+    >>> header['type'], data.nbytes
+    ('bytes', 3)
+    >>> as_buffer([1, 2, 3]) is None
+    True
+    """
+    if not hasattr(memoryview, 'cast'):
+        return None  # pragma: no cover
+    typ = type(value)
+    if typ is bytes or typ is bytearray:
+        return {'type': typ.__name__}, memoryview(value)
+    if typ is memoryview:
+        if not value.c_contiguous or value.format not in _memoryview_formats:
+            return None
+        return ({'type': 'memoryview', 'format': value.format,
+                 'shape': list(value.shape)},
+                value.cast('B'))
+    if typ.__name__ == 'ndarray' and typ.__module__ == 'numpy':
+        if (not value.flags.c_contiguous or value.dtype.hasobject or
+                value.dtype.fields is not None):
+            return None
+        import numpy as np
+        return ({'type': 'ndarray', 'dtype': value.dtype.str,
+                 'shape': list(value.shape)},
+                memoryview(value.reshape(-1).view(np.uint8)))
+    return None
+
+
+def _allocate(header, nbytes):
+    """ Empty value described by header and a writable byte view of it """
+    typ = header['type']
+    if typ == 'ndarray':
+        import numpy as np
+        value = np.empty(header['shape'], dtype=header['dtype'])
+        return value, memoryview(value.reshape(-1).view(np.uint8))
+    buf = bytearray(nbytes)
+    return buf, memoryview(buf)
+
+
+def _finalize(header, value):
+    typ = header['type']
+    if typ == 'bytes':
+        # Only after a direct read; this costs one extra copy
+        return bytes(value)
+    if typ == 'memoryview':
+        return memoryview(value).cast(header['format'], header['shape'])
+    return value
+
+
+def _write_all(fd, buffers):
+    """ Write a list of byte memoryviews, with writev where available """
+    buffers = [b for b in buffers if b.nbytes]
+    if hasattr(os, 'writev'):
+        while buffers:
+            n = os.writev(fd, buffers)
+            while buffers and n >= buffers[0].nbytes:
+                n -= buffers[0].nbytes
+                buffers.pop(0)
+            if n:
+                buffers[0] = buffers[0][n:]
+    else:  # pragma: no cover
+        for b in buffers:
+            while b.nbytes:
+                b = b[os.write(fd, b):]
+
+
+def _open_direct(fn, flags):
+    """ File descriptor opened with O_DIRECT, or None if not supported """
+    if not hasattr(os, 'O_DIRECT'):
+        return None  # pragma: no cover
+    try:
+        return os.open(fn, flags | os.O_DIRECT, 0o666)
+    except OSError:
+        return None
+
+
+def _write_direct(fd, head, data):
+    """ Write aligned blocks through a page-aligned bounce buffer """
+    block = mmap.mmap(-1, CHUNK)
+    view = memoryview(block)
+    try:
+        view[:head.nbytes] = head
+        _write_all(fd, [view[:head.nbytes]])
+        i, n = 0, data.nbytes
+        while i < n:
+            k = min(CHUNK, n - i)
+            view[:k] = data[i:i + k]
+            padded = _round_up(k, ALIGN)
+            view[k:padded] = b'\0' * (padded - k)
+            _write_all(fd, [view[:padded]])
+            i += k
+        os.ftruncate(fd, head.nbytes + n)
+    finally:
+        view.release()
+        block.close()
+
+
+def dump_buffer(value, fn, direct=False):
+    """ Write buffer-like value to file fn
+
+    Returns False, without touching the filesystem, if value does not
+    support the fast path.
+    """
+    result = as_buffer(value)
+    if result is None:
+        return False
+    header, data = result
+    use_direct = direct and data.nbytes >= DIRECT_THRESHOLD
+    header['nbytes'] = data.nbytes
+    header['align'] = ALIGN if use_direct else 1
+    text = json.dumps(header).encode()
+    offset = _round_up(len(MAGIC) + _prefix.size + len(text), header['align'])
+    head = memoryview(MAGIC + _prefix.pack(len(text)) + text +
+                      b' ' * (offset - len(MAGIC) - _prefix.size - len(text)))
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    fd = _open_direct(fn, flags) if use_direct else None
+    try:
+        written = False
+        if fd is not None:
+            try:
+                _write_direct(fd, head, data)
+                written = True
+            except OSError as e:
+                # Some filesystems accept O_DIRECT on open but not on write
+                if e.errno != errno.EINVAL:
+                    raise
+            finally:
+                os.close(fd)
+        if not written:
+            fd = os.open(fn, flags, 0o666)
+            try:
+                _write_all(fd, [head, data])
+            finally:
+                os.close(fd)
+    except BaseException:
+        if os.path.exists(fn):
+            os.remove(fn)
+        raise
+    return True
+
+
+def is_buffer_file(f):
+    """ Does open binary file f hold a raw buffer?  Rewinds f if not """
+    if f.read(len(MAGIC)) == MAGIC:
+        return True
+    f.seek(0)
+    return False
+
+
+def _readinto(f, view):
+    i, n = 0, view.nbytes
+    while i < n:
+        k = f.readinto(view[i:])
+        if not k:
+            raise IOError("Unexpected end of file in %s" % f.name)
+        i += k
+
+
+def _read_bytes(f, n):
+    """ Read exactly n bytes from f into a new bytes object """
+    data = f.read(n)
+    if len(data) != n:
+        raise IOError("Unexpected end of file in %s" % f.name)
+    return data
+
+
+def _read_direct(fn, offset, view):
+    """ Read into view from an O_DIRECT descriptor, False if unsupported
+
+    On False view may be partly filled and should be read again normally.
+    """
+    fd = _open_direct(fn, os.O_RDONLY)
+    if fd is None:
+        return False
+    block = mmap.mmap(-1, CHUNK)
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        i, n = 0, view.nbytes
+        while i < n:
+            try:
+                k = os.readv(fd, [block])
+            except OSError as e:
+                # Some filesystems accept O_DIRECT on open but not on read
+                if e.errno != errno.EINVAL:
+                    raise
+                return False
+            if not k:
+                raise IOError("Unexpected end of file in %s" % fn)
+            k = min(k, n - i)
+            view[i:i + k] = memoryview(block)[:k]
+            i += k
+    finally:
+        block.close()
+        os.close(fd)
+    return True
+
+
+def load_buffer(f, direct=False):
+    """ Load value from file f, positioned just after ``MAGIC`` """
+    n, = _prefix.unpack(f.read(_prefix.size))
+    header = json.loads(f.read(n).decode())
+    align = header['align']
+    offset = _round_up(len(MAGIC) + _prefix.size + n, align)
+    direct = direct and align % ALIGN == 0
+    if header['type'] == 'bytes' and not direct:
+        # bytes are immutable, read straight into the result
+        f.seek(offset)
+        return _read_bytes(f, header['nbytes'])
+    value, view = _allocate(header, header['nbytes'])
+    if not (direct and _read_direct(f.name, offset, view)):
+        f.seek(offset)
+        _readinto(f, view)
+    view.release()
+    return _finalize(header, value)
+
+
+def copy_file(src, dst):
+    """ Copy src to dst, within the kernel where possible
+
+    Used when a hard link is not possible, e.g. across filesystems.  Uses
+    ``copy_file_range`` when available and otherwise ``shutil.copyfile``.
+    """
+    if hasattr(os, 'copy_file_range'):
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                n = os.fstat(fsrc.fileno()).st_size
+                try:
+                    while n > 0:
+                        k = os.copy_file_range(fsrc.fileno(),
+                                               fdst.fileno(), n)
+                        if not k:
+                            break
+                        n -= k
+                except OSError:
+                    n = -1
+        if n == 0:
+            return
+    shutil.copyfile(src, dst)
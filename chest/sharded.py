@@ -0,0 +1,203 @@
+from collections import MutableMapping
+import os
+import zlib
+
+from .core import Chest, DEFAULT_AVAILABLE_MEMORY, key_to_filename
+
+DEFAULT_SHARDS = 8
+
+
+class ShardedChest(MutableMapping):
+    """ A Chest split across several independently locked sub-chests
+
+    Keys are hashed onto one of ``shards`` sub-chests.  Each sub-chest has
+    its own lock, LRU heap and slice of ``available_memory`` so that threads
+    working on different keys rarely contend.  Every so often the memory
+    budget is rebalanced across shards according to how busy each one has
+    been.
+
+    All sub-chests live in numbered subdirectories of a single directory.
+
+    Paramters
+    ---------
+
+    data : dict (optional)
+        An initial dictionary to seed the chest
+    path : str (optional)
+        A directory path to store contents of the chest.  Defaults to a tmp dir
+    available_memory : int, MemoryBudget or 'auto' (optional)
+        Number of bytes that all shards together should use in memory.  A
+        ``MemoryBudget`` (or ``'auto'``) is shared by the shards directly and
+        takes over from ``rebalance``
+    shards : int (optional)
+        Number of sub-chests.  Defaults to the number already on disk under
+        ``path``, or to ``DEFAULT_SHARDS``
+    **kwargs :
+        Passed on to each sub-``Chest`` (dump, load, mode, compute, ...)
+
+    Examples
+    --------
+
+    >>> c = ShardedChest(shards=4)
+    >>> c['x'] = [1, 2, 3]
+    >>> c['x']
+    [1, 2, 3]
+    >>> len(c.shards)
+    4
+
+    >>> c.drop()
+    """
+    rebalance_interval = 1000
+
+    def __init__(self, data=None, path=None, available_memory=None,
+                 shards=None, **kwargs):
+        # Was a path given or no?  If not we'll clean up the directory later
+        self._explicitly_given_path = path is not None
+        if path is None:
+            import tempfile
+            path = tempfile.mkdtemp('.chest')
+        self.path = path
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+        existing = [fn for fn in os.listdir(self.path) if fn.isdigit()]
+        if existing:
+            if shards is not None and shards != len(existing):
+                raise ValueError("Chest at %s has %d shards, not %d"
+                                 % (self.path, len(existing), shards))
+            shards = len(existing)
+        elif shards is None:
+            shards = DEFAULT_SHARDS
+
+        if isinstance(available_memory, str) and available_memory == 'auto':
+            from .memory import default_budget
+            available_memory = default_budget()
+        self.available_memory = (available_memory if available_memory
+                                 is not None else DEFAULT_AVAILABLE_MEMORY)
+        if hasattr(self.available_memory, 'register'):
+            budget = self.available_memory
+        else:
+            budget = self.available_memory / shards
+        # Create shard directories up front so that the shard count persists
+        paths = [os.path.join(self.path, str(i)) for i in range(shards)]
+        for fn in paths:
+            if not os.path.exists(fn):
+                os.mkdir(fn)
+        self.shards = [Chest(path=fn, available_memory=budget, **kwargs)
+                       for fn in paths]
+
+        # Rebalancing state, approximate counts are fine so no lock here
+        self._writes = 0
+        self._counters = [0] * shards
+
+        if data:
+            for k, v in data.items():
+                self[k] = v
+
+    def __str__(self):
+        return '<sharded chest at %s>' % self.path
+
+    def shard(self, key):
+        """ The sub-chest responsible for key """
+        if isinstance(key, str):
+            s = key
+        else:
+            s = key_to_filename(key)
+        # Mask so that Python 2, where crc32 may be negative, agrees with 3
+        h = zlib.crc32(s.encode()) & 0xffffffff
+        return self.shards[h % len(self.shards)]
+
+    def key_to_filename(self, key):
+        """ Filename where key will be held """
+        return self.shard(key).key_to_filename(key)
+
+    def __getitem__(self, key):
+        return self.shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self.shard(key)[key] = value
+
+        self._writes += 1
+        if self._writes >= self.rebalance_interval:
+            self.rebalance()
+
+    def __delitem__(self, key):
+        shard = self.shard(key)
+        with shard.lock:
+            del shard[key]
+
+    def __iter__(self):
+        for shard in self.shards:
+            for key in list(shard):
+                yield key
+
+    def __len__(self):
+        return sum(map(len, self.shards))
+
+    def __contains__(self, key):
+        return key in self.shard(key)
+
+    @property
+    def memory_usage(self):
+        return sum(shard.memory_usage for shard in self.shards)
+
+    def rebalance(self):
+        """ Redistribute ``available_memory`` across shards
+
+        Half of the budget is split evenly, the other half in proportion to
+        LRU activity in each shard since the last rebalance.  With no
+        activity at all the whole budget is split evenly.  Shards that
+        share a ``MemoryBudget`` just refresh it.
+        """
+        self._writes = 0
+        if hasattr(self.available_memory, 'refresh'):
+            self.available_memory.refresh(spill=True)
+            return
+        activity = [shard.counter - old
+                    for shard, old in zip(self.shards, self._counters)]
+        self._counters = [shard.counter for shard in self.shards]
+        total = sum(activity)
+        n = len(self.shards)
+
+        for shard, act in zip(self.shards, activity):
+            if total:
+                share = 0.5 / n + 0.5 * act / total
+            else:  # no activity, split evenly
+                share = 1.0 / n
+            with shard.lock:
+                shard.available_memory = self.available_memory * share
+                shard.shrink()
+
+    def drop(self):
+        """ Permanently remove directory from disk """
+        import shutil
+        for shard in self.shards:
+            shard.drop()
+        shutil.rmtree(self.path)
+
+    def flush(self):
+        """ Flush all in-memory storage to disk """
+        for shard in self.shards:
+            shard.flush()
+
+    def update(self, other, overwrite=True):
+        """ Copy (hard-link) the contents of chest other to this chest
+
+        ``other`` may be a ``Chest`` or a ``ShardedChest``.
+        """
+        self.flush()
+        other.flush()
+        for src in getattr(other, 'shards', [other]):
+            for key in list(src._keys):
+                self.shard(key)._link_from(src, key, overwrite=overwrite)
+
+    def __del__(self):
+        if not self._explicitly_given_path and os.path.exists(self.path):
+            self.drop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, eType, eValue, eTrace):
+        if not self._explicitly_given_path and os.path.exists(self.path):
+            self.drop()
@@ -441,3 +441,351 @@ def test_initial_key_in_chest():
         assert 'banana' in c
         assert c['tofu'] == 'scramble'
         assert c['banana'] == 'smoothie'
+
+
+def test_compute_on_miss():
+    calls = []
+
+    def compute(key):
+        calls.append(key)
+        return key * 2
+
+    with tmp_chest(compute=compute) as c:
+        assert c[1] == 2
+        assert c[1] == 2
+        assert calls == [1]
+        assert 1 in c
+
+        c.flush()
+        os.remove(c.key_to_filename(1))
+        assert c[1] == 2
+        assert calls == [1, 1]
+
+
+def test_compute_on_miss_spills():
+    with tmp_chest(available_memory=0,
+                   compute=lambda k: np.ones(1000, dtype='i4')) as c:
+        assert eq(c['x'], np.ones(1000, dtype='i4'))
+        assert not c.inmem
+        assert os.path.exists(c.key_to_filename('x'))
+
+
+def test_compute_on_miss_single_flight():
+    from multiprocessing.pool import ThreadPool
+    from threading import Lock
+    lock = Lock()
+    calls = []
+
+    def compute(key):
+        with lock:
+            calls.append(key)
+        time.sleep(0.05)
+        return key
+
+    with tmp_chest(compute=compute) as c:
+        pool = ThreadPool(8)
+        results = pool.map(lambda _: c[1], range(16))
+        pool.close()
+        pool.join()
+
+        assert results == [1] * 16
+        assert calls == [1]
+
+
+def test_compute_after_another_thread_stored_key():
+    # A thread that saw the miss but reaches compute() only after another
+    # thread stored the value must not compute it again
+    calls = []
+
+    def compute(key):
+        calls.append(key)
+        return key
+
+    with tmp_chest(compute=compute) as c:
+        assert c[1] == 1
+        assert c.compute(1) == 1
+        c.flush()
+        assert 1 not in c.inmem
+        assert c.compute(1) == 1
+        assert calls == [1]
+
+
+def test_compute_on_miss_single_flight_errors():
+    from multiprocessing.pool import ThreadPool
+    from threading import Lock
+    lock = Lock()
+    calls = []
+
+    def compute(key):
+        with lock:
+            calls.append(key)
+        time.sleep(0.1)
+        raise ValueError(key)
+
+    def get(_):
+        try:
+            c[1]
+        except ValueError:
+            return 'error'
+
+    with tmp_chest(compute=compute) as c:
+        pool = ThreadPool(8)
+        results = pool.map(get, range(8))
+        pool.close()
+        pool.join()
+
+        assert results == ['error'] * 8
+        assert calls == [1]
+        assert 1 not in c
+        assert not c._computing
+
+
+def test_compute_errors_propagate():
+    def compute(key):
+        raise KeyError(key)
+
+    with tmp_chest(compute=compute) as c:
+        assert raises(KeyError, lambda: c[1])
+        assert 1 not in c
+        assert not c._computing
+
+
+def test_raw_buffers():
+    x = np.arange(1000, dtype='f8').reshape(10, 100)
+    with tmp_chest(available_memory=0) as c:
+        c['x'] = x
+        c['b'] = b'hello'
+        c['m'] = memoryview(b'world')
+
+        from chest.rawio import MAGIC
+        for key in ['x', 'b', 'm']:
+            with open(c.key_to_filename(key), 'rb') as f:
+                assert f.read(len(MAGIC)) == MAGIC
+
+        y = c['x']
+        assert y.dtype == x.dtype and y.shape == x.shape
+        assert eq(y, x)
+        assert c['b'] == b'hello'
+        assert c['m'].tobytes() == b'world'
+
+
+def test_raw_buffers_off():
+    with tmp_chest(available_memory=0, raw_buffers=False) as c:
+        c['b'] = b'hello'
+        with open(c.key_to_filename('b'), 'rb') as f:
+            assert pickle.load(f) == b'hello'
+        assert c['b'] == b'hello'
+
+
+def test_direct_io():
+    x = np.random.random(300000)
+    with tmp_chest(available_memory=0, direct_io=True) as c:
+        c['x'] = x
+        assert os.path.getsize(c.key_to_filename('x')) == 4096 + x.nbytes
+        assert eq(c['x'], x)
+
+
+def test_update_copies_when_link_fails():
+    link = os.link
+
+    def bad_link(src, dst):
+        raise OSError(18, 'Invalid cross-device link')
+
+    with tmp_chest() as c1:
+        with tmp_chest() as c2:
+            c2['x'] = np.ones(100)
+            c2['y'] = 'why'
+            os.link = bad_link
+            try:
+                c1.update(c2)
+            finally:
+                os.link = link
+            assert eq(c1['x'], np.ones(100))
+            assert c1['y'] == 'why'
+            assert (os.stat(c1.key_to_filename('y')).st_ino !=
+                    os.stat(c2.key_to_filename('y')).st_ino)
+
+
+def test_snapshot():
+    with tmp_chest(available_memory=100) as c:
+        c['a'] = 'A'
+        c['x'] = np.arange(100)
+        c.flush()
+        c['b'] = 'B'
+
+        s = c.snapshot()
+        assert set(s) == set(['a', 'b', 'x'])
+        assert (os.stat(s.key_to_filename('x')).st_ino ==
+                os.stat(c.key_to_filename('x')).st_ino)
+
+        c['a'] = 'AA'
+        c['x'] = np.zeros(100)
+        c['c'] = 'C'
+        del c['b']
+        c.flush()
+
+        assert s['a'] == 'A'
+        assert s['b'] == 'B'
+        assert eq(s['x'], np.arange(100))
+        assert 'c' not in s
+        assert c['a'] == 'AA'
+        assert eq(c['x'], np.zeros(100))
+
+        assert raises(TypeError, lambda: s.__setitem__('a', 1))
+        assert raises(TypeError, lambda: s.__delitem__('a'))
+        with tmp_chest() as other:
+            other['y'] = 'Y'
+            assert raises(TypeError, lambda: s.update(other))
+            assert raises(TypeError, lambda: s._link_from(other, 'y'))
+        assert 'y' not in s
+
+        path = s.path
+        del s
+        import gc
+        gc.collect()
+        assert not os.path.exists(path)
+
+
+def test_directory_created_lazily():
+    c = Chest(available_memory=100)
+    c[1] = 'one'
+    del c[1]
+    c[2] = 'two'
+    assert 'not yet created' in str(c)
+    assert c._path is None
+
+    for i in range(20):
+        c[i] = i
+    assert os.path.exists(c.path)
+    c.drop()
+
+
+def test_del_on_normal_path_without_spill():
+    path = '_chest_test_lazy_path'
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    c = Chest(path=path)
+    c[1] = 'one'
+    assert not os.path.exists(path)
+
+    del c
+    import gc
+    gc.collect()
+
+    c = Chest(path=path)
+    assert c[1] == 'one'
+    c.drop()
+
+
+def test_raw_buffers_respect_custom_dump():
+    import zlib
+
+    def dump(obj, f):
+        f.write(zlib.compress(pickle.dumps(obj)))
+
+    def load(f):
+        return pickle.loads(zlib.decompress(f.read()))
+
+    x = np.zeros(100000)
+    with tmp_chest(available_memory=0, dump=dump, load=load) as c:
+        c['x'] = x
+        assert os.path.getsize(c.key_to_filename('x')) < x.nbytes / 10
+        assert eq(c['x'], x)
+
+
+def test_raw_buffer_files_load_without_raw_buffers():
+    with tmp_chest(available_memory=0) as c:
+        c['b'] = b'hello'
+        c.flush()
+
+        c2 = Chest(path=c.path, raw_buffers=False)
+        assert c2['b'] == b'hello'
+
+
+def test_update_raises_when_link_fails_otherwise():
+    link = os.link
+
+    def bad_link(src, dst):
+        raise OSError(13, 'Permission denied')
+
+    with tmp_chest() as c1:
+        with tmp_chest() as c2:
+            c2['y'] = 'why'
+            os.link = bad_link
+            try:
+                assert raises(OSError, lambda: c1.update(c2))
+            finally:
+                os.link = link
+
+
+def test_snapshot_of_in_memory_values():
+    class Undumpable(object):
+        def __getstate__(self):
+            raise TypeError()
+
+    with tmp_chest() as c:
+        c['x'] = np.zeros(3)
+        u = Undumpable()
+        c['u'] = u
+        s = c.snapshot()
+        c['x'] += 1
+        assert eq(c['x'], np.ones(3))
+        assert eq(s['x'], np.zeros(3))
+        assert s['u'] is u
+
+        del c['u']
+        c.flush()
+        os.remove(c.key_to_filename('x'))
+        s2 = c.snapshot()
+        assert 'x' not in s2
+
+
+def test_snapshot_keeps_directory_lazy():
+    c = Chest()
+    c['x'] = 1
+    s = c.snapshot()
+    assert c._path is None
+    assert s['x'] == 1
+    c['x'] = 2
+    assert s['x'] == 1
+    assert c._path is None
+
+
+def test_snapshot_of_unpicklable_values():
+    class Local(object):
+        pass
+
+    with tmp_chest() as c:
+        c['f'] = lambda x: x
+        obj = Local()
+        c['obj'] = obj
+        c['x'] = 1
+        s = c.snapshot()
+        assert s['f'] is c['f']
+        assert s['obj'] is obj
+        assert s['x'] == 1
+        assert not os.path.exists(s.key_to_filename('f'))
+        assert not os.path.exists(s.key_to_filename('obj'))
+
+
+def test_failed_snapshot_leaves_no_directory():
+    import tempfile
+    parent = tempfile.mkdtemp()
+    link = os.link
+
+    def bad_link(src, dst):
+        raise OSError(13, 'Permission denied')
+
+    try:
+        c = Chest(path=os.path.join(parent, 'c'))
+        c['x'] = 1
+        c.flush()
+        os.link = bad_link
+        try:
+            assert raises(OSError, c.snapshot)
+        finally:
+            os.link = link
+        assert os.listdir(parent) == ['c']
+    finally:
+        shutil.rmtree(parent)
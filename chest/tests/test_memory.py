@@ -0,0 +1,230 @@
+from chest.memory import MemoryBudget, default_budget, memory_stats
+from chest.sharded import ShardedChest
+from chest.core import Chest
+from chest import memory
+from contextlib import contextmanager
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+
+def fake_budget(**stats):
+    budget = MemoryBudget(target=0.8, interval=1000)
+    budget.stats = lambda: stats
+    return budget
+
+
+def close(a, b):
+    return abs(a - b) < 1e-6
+
+
+def test_memory_stats():
+    stats = memory_stats()
+    assert set(stats) == set(['limit', 'free', 'rss'])
+    if stats['limit'] is not None:
+        assert stats['limit'] > 0
+        assert 0 <= stats['free'] <= stats['limit']
+
+
+def test_budget_splits_headroom():
+    budget = fake_budget(limit=1000, free=500, rss=300)
+    with Chest(available_memory=budget) as a:
+        with Chest(available_memory=budget) as b:
+            budget.refresh()
+            # min(0 + 500 - 200, 800 - 300) split two ways
+            assert close(a.available_memory, 150)
+            assert close(b.available_memory, 150)
+
+
+def test_register_uses_last_share():
+    budget = fake_budget(limit=1000, free=500, rss=300)
+    calls = []
+    stats = budget.stats
+    budget.stats = lambda: calls.append(1) or stats()
+    with Chest(available_memory=budget) as a:
+        assert len(calls) == 1  # first chest refreshes
+        assert close(a.available_memory, 300)
+        with Chest(available_memory=budget) as b:
+            assert len(calls) == 1
+            assert close(b.available_memory, 300)
+            assert b in budget.chests.values()
+
+
+def test_budget_spills_under_pressure():
+    budget = fake_budget(limit=1000, free=900, rss=300)
+    with Chest(available_memory=budget) as a:
+        with Chest(available_memory=budget) as b:
+            a['x'] = np.ones(20)  # 160 bytes
+            budget.refresh()
+            assert 'x' in a.inmem
+            assert a.available_memory > b.available_memory
+
+            budget.stats = lambda: dict(limit=1000, free=100, rss=300)
+            budget.refresh(spill=True)
+            assert a.available_memory < 160
+            assert 'x' not in a.inmem
+            assert (a['x'] == 1).all()
+
+            budget.stats = lambda: dict(limit=1000, free=900, rss=300)
+            budget.refresh()
+            assert a.available_memory > 160
+
+
+def test_budget_without_stats():
+    budget = fake_budget(limit=None, free=None, rss=None)
+    with Chest(available_memory=budget) as c:
+        assert c.available_memory > 0
+
+
+def test_auto():
+    with Chest(available_memory='auto') as c:
+        assert c._budget is default_budget()
+        assert c in default_budget().chests.values()
+
+    with ShardedChest(shards=2, available_memory='auto') as c:
+        assert c.available_memory is default_budget()
+        assert all(s._budget is default_budget() for s in c.shards)
+
+
+def test_sharded_chest_shares_budget():
+    budget = fake_budget(limit=1000, free=500, rss=300)
+    with ShardedChest(shards=3, available_memory=budget) as c:
+        assert all(s._budget is budget for s in c.shards)
+        c.rebalance()
+        assert all(close(s.available_memory, 100) for s in c.shards)
+        c['x'] = 1
+        assert c['x'] == 1
+
+
+def test_start_stop():
+    budget = MemoryBudget(interval=0.01)
+    budget.start()
+    budget.start()
+    budget.stop()
+    budget.stop()
+    assert budget._thread is None
+
+
+def test_read_int():
+    from chest.memory import _read_int
+    fn = '_memory_test_file'
+    with open(fn, 'w') as f:
+        f.write('max\n')
+    try:
+        assert _read_int(fn) is None
+        assert _read_int('_memory_no_such_file') is None
+    finally:
+        os.remove(fn)
+
+
+@contextmanager
+def fake_cgroups(lines, files):
+    """ Point chest.memory at a fake /proc/self/cgroup and cgroup tree """
+    root = tempfile.mkdtemp()
+    old = memory.PROC_CGROUP, memory.CGROUP_V2, memory.CGROUP_V1
+    memory.PROC_CGROUP = os.path.join(root, 'cgroup')
+    memory.CGROUP_V2 = os.path.join(root, 'v2')
+    memory.CGROUP_V1 = os.path.join(root, 'v1')
+    with open(memory.PROC_CGROUP, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    for name, value in files.items():
+        fn = os.path.join(root, name)
+        if not os.path.exists(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with open(fn, 'w') as f:
+            f.write(value)
+    try:
+        yield
+    finally:
+        memory.PROC_CGROUP, memory.CGROUP_V2, memory.CGROUP_V1 = old
+        shutil.rmtree(root)
+
+
+def test_own_cgroups():
+    with fake_cgroups(['4:memory:/jobs/a', '1:cpu:/', '0::/jobs/b', 'bad'],
+                      {}):
+        assert memory.own_cgroups() == ('jobs/b', 'jobs/a')
+    with fake_cgroups([], {}):
+        os.remove(memory.PROC_CGROUP)
+        assert memory.own_cgroups() == ('', '')
+
+
+def test_memory_stats_uses_own_cgroup_v1():
+    files = {'v1/memory.limit_in_bytes': '9223372036854771712',
+             'v1/jobs/memory.limit_in_bytes': '5000',
+             'v1/jobs/memory.usage_in_bytes': '1000',
+             'v1/jobs/a/memory.limit_in_bytes': '9000',
+             'v1/jobs/a/memory.usage_in_bytes': '500'}
+    with fake_cgroups(['4:memory:/jobs/a', '0::/'], files):
+        stats = memory_stats()
+        assert stats['limit'] == 5000
+        assert stats['free'] == 4000
+
+    # Inactive page cache can be reclaimed and is not counted as used
+    files['v1/jobs/memory.stat'] = ('cache 800\ninactive_file 300\n'
+                                    'total_inactive_file 600\n')
+    with fake_cgroups(['4:memory:/jobs/a', '0::/'], files):
+        assert memory_stats()['free'] == 4600
+
+
+def test_memory_stats_uses_own_cgroup_v2():
+    files = {'v2/memory.max': 'max',
+             'v2/jobs/memory.max': '3000',
+             'v2/jobs/memory.current': '1000'}
+    with fake_cgroups(['0::/jobs'], files):
+        stats = memory_stats()
+        assert stats['limit'] == 3000
+        assert stats['free'] == 2000
+
+    files['v2/jobs/memory.stat'] = 'anon 200\ninactive_file 700\n'
+    with fake_cgroups(['0::/jobs'], files):
+        assert memory_stats()['free'] == 2700
+
+    files['v2/jobs/memory.stat'] = 'inactive_file 5000\n'
+    with fake_cgroups(['0::/jobs'], files):
+        assert memory_stats()['free'] == 3000
+
+    files['v2/jobs/memory.stat'] = 'inactive_file lots\n'
+    with fake_cgroups(['0::/jobs'], files):
+        assert memory_stats()['free'] == 2000
+
+
+def test_refresh_without_chests():
+    budget = MemoryBudget()
+    budget.refresh()
+    assert not budget.chests
+
+
+def test_writes_refresh_budget():
+    budget = fake_budget(limit=1000, free=900, rss=300)
+    budget.interval = 0
+    with Chest(available_memory=budget) as c:
+        c['x'] = np.ones(20)  # 160 bytes
+        assert 'x' in c.inmem
+
+        budget.stats = lambda: dict(limit=1000, free=100, rss=300)
+        c['y'] = 1
+        assert c.available_memory < 160
+        assert 'x' not in c.inmem
+
+
+def test_background_thread_spills():
+    budget = fake_budget(limit=1000, free=900, rss=300)
+    with Chest(available_memory=budget) as c:
+        c['x'] = np.ones(20)  # 160 bytes
+        assert 'x' in c.inmem
+
+        budget.stats = lambda: dict(limit=1000, free=100, rss=300)
+        budget.interval = 0.01
+        budget.start()
+        try:
+            for i in range(200):
+                if 'x' not in c.inmem:
+                    break
+                time.sleep(0.01)
+        finally:
+            budget.stop()
+        assert 'x' not in c.inmem
+        assert (c['x'] == 1).all()
@@ -0,0 +1,169 @@
+from chest import rawio
+from chest.rawio import dump_buffer, is_buffer_file, load_buffer, copy_file
+from chest.utils import raises
+import errno
+import os
+import numpy as np
+
+
+def roundtrip(value, fn, direct=False):
+    assert dump_buffer(value, fn, direct=direct)
+    with open(fn, 'rb') as f:
+        assert is_buffer_file(f)
+        return load_buffer(f, direct=direct)
+
+
+def test_roundtrip():
+    fn = '_rawio_test_file'
+    try:
+        assert roundtrip(b'abc', fn) == b'abc'
+        assert roundtrip(bytearray(b'abc'), fn) == bytearray(b'abc')
+        x = np.arange(12, dtype='i4').reshape(3, 4)
+        y = roundtrip(x, fn)
+        assert y.dtype == x.dtype and (y == x).all()
+        m = roundtrip(memoryview(x), fn)
+        assert m.shape == (3, 4) and m.tolist() == x.tolist()
+        big = b'x' * rawio.DIRECT_THRESHOLD
+        assert roundtrip(big, fn, direct=True) == big
+    finally:
+        os.remove(fn)
+
+
+def test_not_buffers():
+    assert rawio.as_buffer([1, 2, 3]) is None
+    assert rawio.as_buffer(np.arange(10)[::2]) is None
+    assert rawio.as_buffer(np.array(['a', 1], dtype=object)) is None
+    assert rawio.as_buffer(memoryview(np.arange(10)[::2])) is None
+    assert not dump_buffer([1, 2, 3], '_rawio_test_file')
+    assert not os.path.exists('_rawio_test_file')
+
+
+def test_direct_falls_back_on_einval():
+    fn = '_rawio_test_file'
+    x = np.random.random(300000)
+    write_direct, readv = rawio._write_direct, os.readv
+
+    def einval(*args):
+        raise OSError(errno.EINVAL, 'Invalid argument')
+
+    rawio._write_direct = einval
+    os.readv = einval
+    try:
+        assert (roundtrip(x, fn, direct=True) == x).all()
+    finally:
+        rawio._write_direct, os.readv = write_direct, readv
+        os.remove(fn)
+
+
+def test_failed_write_leaves_no_file():
+    fn = '_rawio_test_file'
+    write_all = rawio._write_all
+
+    def fail(*args):
+        raise IOError('disk full')
+
+    rawio._write_all = fail
+    try:
+        assert raises(IOError, lambda: dump_buffer(b'abc', fn))
+    finally:
+        rawio._write_all = write_all
+    assert not os.path.exists(fn)
+
+
+def test_copy_file():
+    src, dst = '_rawio_test_src', '_rawio_test_dst'
+    with open(src, 'wb') as f:
+        f.write(b'x' * 10000)
+
+    def check():
+        copy_file(src, dst)
+        with open(dst, 'rb') as f:
+            assert f.read() == b'x' * 10000
+        os.remove(dst)
+
+    try:
+        check()
+        if hasattr(os, 'copy_file_range'):
+            copy_file_range = os.copy_file_range
+
+            def fail(*args):
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+            os.copy_file_range = fail
+            try:
+                check()
+                os.copy_file_range = lambda *args: 0
+                check()
+            finally:
+                os.copy_file_range = copy_file_range
+    finally:
+        os.remove(src)
+
+
+def test_partial_writes():
+    fn = '_rawio_test_file'
+    writev = os.writev
+
+    def short_writev(fd, buffers):
+        return os.write(fd, buffers[0][:3])
+
+    os.writev = short_writev
+    try:
+        assert roundtrip(b'abcdefghij', fn) == b'abcdefghij'
+    finally:
+        os.writev = writev
+        os.remove(fn)
+
+
+def test_direct_unavailable():
+    assert rawio._open_direct('_rawio_no_such_dir/x', os.O_RDONLY) is None
+    view = memoryview(bytearray(10))
+    assert not rawio._read_direct('_rawio_no_such_dir/x', 0, view)
+
+
+def test_direct_other_errors_raise():
+    fn = '_rawio_test_file'
+    x = np.random.random(300000)
+    write_direct, readv = rawio._write_direct, os.readv
+
+    def eio(*args):
+        raise OSError(errno.EIO, 'Input/output error')
+
+    try:
+        rawio._write_direct = eio
+        assert raises(OSError, lambda: dump_buffer(x, fn, direct=True))
+        assert not os.path.exists(fn)
+        rawio._write_direct = write_direct
+
+        assert dump_buffer(x, fn, direct=True)
+        os.readv = eio
+        with open(fn, 'rb') as f:
+            assert is_buffer_file(f)
+            assert (rawio._open_direct(fn, os.O_RDONLY) is None or
+                    raises(OSError, lambda: load_buffer(f, direct=True)))
+    finally:
+        rawio._write_direct, os.readv = write_direct, readv
+        if os.path.exists(fn):
+            os.remove(fn)
+
+
+def test_truncated_file():
+    fn = '_rawio_test_file'
+    x = np.random.random(300000)
+    try:
+        for direct in [False, True]:
+            assert dump_buffer(x, fn, direct=direct)
+            with open(fn, 'r+b') as f:
+                f.truncate(x.nbytes // 2)
+            with open(fn, 'rb') as f:
+                assert is_buffer_file(f)
+                assert raises(IOError, lambda: load_buffer(f, direct=direct))
+
+        assert dump_buffer(b'abc', fn)
+        with open(fn, 'r+b') as f:
+            f.truncate(os.path.getsize(fn) - 1)
+        with open(fn, 'rb') as f:
+            assert is_buffer_file(f)
+            assert raises(IOError, lambda: load_buffer(f))
+    finally:
+        os.remove(fn)
@@ -0,0 +1,153 @@
+from chest.sharded import ShardedChest
+from chest.core import Chest
+import os
+import shutil
+import numpy as np
+
+
+def test_basic():
+    with ShardedChest(shards=4) as c:
+        c[1] = 'one'
+        c['two'] = 2
+        c['three', 3] = 3
+
+        assert c[1] == 'one'
+        assert c['two'] == 2
+        assert c['three', 3] == 3
+
+        assert len(c) == 3
+        assert set(c) == set([1, 'two', ('three', 3)])
+        assert 1 in c
+
+        del c[1]
+        assert 1 not in c
+        assert len(c) == 2
+
+
+def test_one_directory():
+    with ShardedChest(shards=4) as c:
+        for i in range(20):
+            c[i] = i
+        c.flush()
+
+        assert sorted(os.listdir(c.path)) == ['0', '1', '2', '3']
+        for i in range(20):
+            fn = c.key_to_filename(i)
+            assert fn.startswith(c.path)
+            assert os.path.exists(fn)
+
+    assert not os.path.exists(c.path)
+
+
+def test_shards_are_independent():
+    with ShardedChest(shards=4) as c:
+        for i in range(20):
+            c[i] = i
+        assert len(set(id(s.lock) for s in c.shards)) == 4
+        assert sum(len(s) for s in c.shards) == 20
+        assert all(c.shard(i)[i] == i for i in range(20))
+
+
+def test_shard_is_stable_across_pythons():
+    # crc32(b'x') is 2363233923 on Python 3 and negative on Python 2
+    with ShardedChest(shards=3) as c:
+        assert c.shard('x') is c.shards[2363233923 % 3]
+
+
+def test_limited_storage():
+    x = np.ones(1000, dtype='i4')
+    with ShardedChest(shards=2, available_memory=8000) as c:
+        for i in range(10):
+            c[i] = x
+        assert c.memory_usage <= c.available_memory
+        assert all((c[i] == x).all() for i in range(10))
+
+
+def test_rebalance():
+    with ShardedChest(shards=4, available_memory=1000) as c:
+        c.rebalance()
+        assert all(s.available_memory == 250 for s in c.shards)
+
+    with ShardedChest(shards=2, available_memory=1000) as c:
+        busy = c.shard('x')
+        for i in range(50):
+            c['x'] = i
+        c.rebalance()
+
+        assert busy.available_memory > c.available_memory / 2
+        assert (sum(s.available_memory for s in c.shards) ==
+                c.available_memory)
+
+
+def test_reopen():
+    path = '_sharded_chest_test_path'
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    c = ShardedChest(path=path, shards=3)
+    c['x'] = 1
+    c[('y', 2)] = 2
+    c.flush()
+
+    c2 = ShardedChest(path=path)
+    assert len(c2.shards) == 3
+    assert c2['x'] == 1
+    assert c2[('y', 2)] == 2
+
+    try:
+        ShardedChest(path=path, shards=5)
+        assert False
+    except ValueError:
+        pass
+
+    c2.drop()
+
+
+def test_update():
+    with ShardedChest(shards=3) as c1:
+        with ShardedChest(shards=2) as c2:
+            c1['foo'] = 'bar'
+            c1['bar'] = 'bbq'
+            c2['bar'] = 'foo'
+            c2['spam', 'spam'] = 'eggs'
+            c1.update(c2)
+            assert c1['foo'] == 'bar'
+            assert c1['bar'] == 'foo'
+            assert c1['spam', 'spam'] == 'eggs'
+
+        c = Chest()
+        c['eggs'] = 'ham'
+        c1.update(c)
+        assert c1['eggs'] == 'ham'
+        c.drop()
+
+
+def test_automatic_rebalance():
+    with ShardedChest(shards=2, available_memory=1000) as c:
+        c.rebalance_interval = 10
+        busy = c.shard('x')
+        for i in range(10):
+            c['x'] = i
+        assert c._writes == 0
+        assert busy.available_memory > 500
+
+
+def test_seed_data():
+    with ShardedChest({'x': 1, ('y', 2): 2}, shards=3) as c:
+        assert len(c) == 2
+        assert c['x'] == 1
+        assert c['y', 2] == 2
+
+
+def test_defaults_str_and_del():
+    c = ShardedChest()
+    assert len(c.shards) == 8
+    assert c.path in str(c)
+    c[1] = 'one'
+    c.flush()
+
+    path = c.path
+    del c
+    import gc
+    gc.collect()
+    assert not os.path.exists(path)